@@ -7,11 +7,12 @@ This software may be modified and distributed under the terms
 of the BSD license. See the LICENSE file for details.
 """
 
-import json
+import io
 import logging
 import os
 import re
 from contextlib import contextmanager
+from functools import lru_cache
 from shlex import quote
 
 from .constants import DOCKERFILE_FILENAME, COMMENT_INSTRUCTION
@@ -21,6 +22,31 @@ from .util import (b2u, extract_key_values, get_key_val_dictionary,
 
 logger = logging.getLogger(__name__)
 
+# regexes used for parsing the Dockerfile structure
+_INSTRUCTION_RE = re.compile(r'^\s*(\S+)\s+(.*)$')  # matched group is insn
+_COMMENT_PREFIX_RE = re.compile(r'^\s*#\s*')        # comment marker to strip
+_ESCAPE_DIRECTIVE_RE = re.compile(r'^\s*#\s*escape\s*=\s*(\\|`)\s*$', re.I)
+_SYNTAX_DIRECTIVE_RE = re.compile(r'^\s*#\s*syntax\s*=\s*(.*)\s*$', re.I)
+# line continues? -- for each escape character allowed by the escape directive;
+# matched group is the line without the escape character and line ending
+_CONTINUATION_RES = {
+    char: re.compile(r'^(.*)' + re.escape(char) + r'\s*$') for char in ('\\', '`')
+}
+
+_LINE_RE = re.compile(r'[^\n]*\n|[^\n]+')  # a single line of content
+
+# regex used for parsing the value of a FROM instruction
+_IMAGE_FROM_RE = re.compile(r"""(?xi)   # readable, case-insensitive regex
+    \s*                                 # ignore leading whitespace
+    (?P<platform> --platform=\S+)?      # optional platform parameter
+    \s*                                 # more whitespaces
+    (?P<image> \S+ )                    # image and optional tag
+    (?:                                 # optional "AS name" clause for stage
+        \s+ AS \s+
+        (?P<name> \S+ )
+    )?
+    """)
+
 
 class KeyValues(dict):
     """
@@ -29,6 +55,7 @@ class KeyValues(dict):
 
     Subclasses must override the `parser_attr` value.
     """
+    __slots__ = ('parser',)
     parser_attr = None
 
     def __init__(self, key_values, parser):
@@ -49,6 +76,7 @@ class KeyValues(dict):
         return dict(self) == other
 
     def __hash__(self):
+        import json  # only needed here and in DockerfileParser.json
         return hash(json.dumps(self, separators=(',', ':'), sort_keys=True))
 
 
@@ -58,6 +86,7 @@ class Labels(KeyValues):
 
     parser.labels['label'] = 'value'
     """
+    __slots__ = ()
     parser_attr = 'labels'
 
 
@@ -67,6 +96,7 @@ class Envs(KeyValues):
 
     parser.envs['variable_name'] = 'value'
     """
+    __slots__ = ()
     parser_attr = 'envs'
 
 
@@ -76,6 +106,7 @@ class Args(KeyValues):
 
     parser.args['variable_name'] = 'value'
     """
+    __slots__ = ()
     parser_attr = 'args'
 
 
@@ -115,6 +146,8 @@ class DockerfileParser(object):
 
         self.cache_content = cache_content
         self.cached_content = ''  # unicode string
+        # (content, lines, structure) of the most recently parsed content
+        self._structure_cache = None
 
         if cache_content:
             try:
@@ -140,6 +173,18 @@ class DockerfileParser(object):
             logger.debug("Setting build args: %s", build_args)
             self.build_args = build_args
 
+    @classmethod
+    def from_string(cls, content, **kwargs):
+        """
+        Create a parser for Dockerfile content held in memory; the content
+        is never read from or written to the filesystem
+        :param content: string (unicode or bytes) with Dockerfile content
+        :param kwargs: other parameters of DockerfileParser except path and fileobj
+        :return: DockerfileParser instance
+        """
+        kwargs.setdefault('cache_content', True)
+        return cls(fileobj=io.BytesIO(u2b(content)), **kwargs)
+
     @contextmanager
     def _open_dockerfile(self, mode):
         if self.fileobj is not None:
@@ -157,18 +202,13 @@ class DockerfileParser(object):
         """
         :return: list containing lines (unicode) from Dockerfile
         """
-        if self.cache_content and self.cached_content:
-            return self.cached_content.splitlines(True)
-
-        try:
-            with self._open_dockerfile('rb') as dockerfile:
-                lines = [b2u(line) for line in dockerfile.readlines()]
-                if self.cache_content:
-                    self.cached_content = ''.join(lines)
-                return lines
-        except (IOError, OSError) as ex:
-            logger.error("Couldn't retrieve lines from dockerfile: %r", ex)
-            raise
+        # read (or take from the cache) and decode the content only once,
+        # then split it the same way file.readlines() would
+        content = self.content
+        if self._structure_cache is not None and self._structure_cache[0] == content:
+            # already split when the structure was parsed
+            return list(self._structure_cache[1])
+        return _split_lines(content)
 
     @lines.setter
     def lines(self, lines):
@@ -176,12 +216,18 @@ class DockerfileParser(object):
         Fill Dockerfile content with specified lines
         :param lines: list of lines to be written to Dockerfile
         """
+        lines = list(lines)  # a generator could only be joined once
+        try:
+            content = ''.join(lines)
+        except TypeError:
+            # some lines are bytes, decode them one by one
+            content = ''.join(b2u(line) for line in lines)
         if self.cache_content:
-            self.cached_content = ''.join(b2u(line) for line in lines)
+            self.cached_content = content
 
         try:
             with self._open_dockerfile('wb') as dockerfile:
-                dockerfile.writelines(u2b(line) for line in lines)
+                dockerfile.write(u2b(content))
         except (IOError, OSError) as ex:
             logger.error("Couldn't write lines to dockerfile: %r", ex)
             raise
@@ -238,6 +284,39 @@ class DockerfileParser(object):
              "value": "yum -y update && yum clean all"}
         ]
         """
+        # callers are free to modify the returned list and dicts, so hand out copies
+        return [dict(instr) for instr in self._cached_structure()[1]]
+
+    def _cached_structure(self):
+        """
+        Get lines and structure of the current content, parsing it only if it changed
+
+        :return: tuple of list of lines and list of dicts describing the commands,
+            shared with the cache and therefore not to be modified
+        """
+        content = self.content
+        if self._structure_cache is None or self._structure_cache[0] != content:
+            lines = _split_lines(content)
+            self._structure_cache = (content, lines, self._parse_structure(lines))
+        return self._structure_cache[1:]
+
+    def _lines_and_structure(self):
+        """
+        Get lines and structure of the Dockerfile from a single read of its content
+
+        :return: tuple of list of lines and list of dicts describing the commands
+        """
+        # callers are free to modify the returned lists and dicts, so hand out copies
+        lines, structure = self._cached_structure()
+        return list(lines), [dict(instr) for instr in structure]
+
+    def _parse_structure(self, lines):
+        """
+        Parse lines of a Dockerfile, see the structure property for details
+
+        :param lines: list of lines (unicode) to parse
+        :return: list of dicts describing the commands
+        """
         def _rstrip_eol(text, line_continuation_char='\\'):
             text = text.rstrip()
             if text.endswith(line_continuation_char):
@@ -254,37 +333,39 @@ class DockerfileParser(object):
             }
 
         def _clean_comment_line(line):
-            line = re.sub(r'^\s*#\s*', '', line)
-            line = re.sub(r'\n', '', line)
+            line = _COMMENT_PREFIX_RE.sub('', line, count=1)
+            line = line.replace('\n', '')
             return line
 
+        # local names for what is looked up on every line
+        comment_instruction = COMMENT_INSTRUCTION
+        instruction_match = _INSTRUCTION_RE.match
+
         instructions = []
         lineno = -1
         line_continuation_char = '\\'
-        insnre = re.compile(r'^\s*(\S+)\s+(.*)$')  # matched group is insn
-        contre = re.compile(r'^.*\\\s*$')          # line continues?
-        commentre = re.compile(r'^\s*#')           # line is a comment?
+        contre = _CONTINUATION_RES[line_continuation_char]
         directive_possible = True
-        # escape directive regex
-        escape_directive_re = re.compile(r'^\s*#\s*escape\s*=\s*(\\|`)\s*$', re.I)
-        # syntax directive regex
-        syntax_directive_re = re.compile(r'^\s*#\s*syntax\s*=\s*(.*)\s*$', re.I)
 
         in_continuation = False
         current_instruction = {}
+        # pieces of a multi-line instruction, joined once it is complete
+        content_parts = []
+        value_parts = []
 
-        for line in self.lines:
+        for line in lines:
             lineno += 1
+            is_comment = line.lstrip().startswith('#')
 
             if directive_possible:
-                # once support for python versions before 3.8 is dropped use walrus operator
-                if escape_directive_re.match(line):
-                    # Do the matching twice if there is a directive to avoid doing the matching
-                    # for other lines
-                    match = escape_directive_re.match(line)
-                    line_continuation_char = match.group(1)
-                    contre = re.compile(r'^.*' + re.escape(match.group(1)) + r'\s*$')
-                elif syntax_directive_re.match(line):
+                # directives are comments, no need to try matching other lines
+                escape_match = is_comment and _ESCAPE_DIRECTIVE_RE.match(line)
+                if not is_comment:
+                    directive_possible = False
+                elif escape_match:
+                    line_continuation_char = escape_match.group(1)
+                    contre = _CONTINUATION_RES[line_continuation_char]
+                elif _SYNTAX_DIRECTIVE_RE.match(line):
                     # Currently no information for the syntax directive is stored it is still
                     # necessary to detect escape directives after a syntax directive
                     pass
@@ -293,34 +374,41 @@ class DockerfileParser(object):
 
             # It is necessary to keep instructions and comment parsing separate,
             # as a multi-line instruction can be interjected with comments.
-            if commentre.match(line):
+            if is_comment:
                 comment = _create_instruction_dict(
-                    instruction=COMMENT_INSTRUCTION,
+                    instruction=comment_instruction,
                     value=_clean_comment_line(line)
                 )
                 instructions.append(comment)
 
             else:
                 if not in_continuation:
-                    m = insnre.match(line)
+                    m = instruction_match(line)
                     if not m:
                         continue
                     current_instruction = _create_instruction_dict(
                         instruction=m.groups()[0].upper(),
                         value=_rstrip_eol(m.groups()[1], line_continuation_char)
                     )
+                    content_parts = [line]
+                    value_parts = [current_instruction['value']]
+                    in_continuation = contre.match(line)
                 else:
-                    current_instruction['content'] += line
+                    content_parts.append(line)
                     current_instruction['endline'] = lineno
 
-                    if current_instruction['value']:
-                        current_instruction['value'] += _rstrip_eol(line, line_continuation_char)
+                    # one match tells whether the instruction goes on and strips the line
+                    in_continuation = contre.match(line)
+                    value = in_continuation.group(1) if in_continuation else line.rstrip()
+                    # value_parts is a single item until a non-empty piece is found
+                    if value_parts[0]:
+                        value_parts.append(value)
                     else:
-                        current_instruction['value'] = _rstrip_eol(line.lstrip(),
-                                                                   line_continuation_char)
+                        value_parts = [value.lstrip()]
 
-                in_continuation = contre.match(line)
                 if not in_continuation and current_instruction:
+                    current_instruction['content'] = ''.join(content_parts)
+                    current_instruction['value'] = ''.join(value_parts)
                     instructions.append(current_instruction)
 
         return instructions
@@ -330,6 +418,7 @@ class DockerfileParser(object):
         """
         :return: JSON formatted string with instructions & values from Dockerfile
         """
+        import json  # rarely used, keep it out of the module import time
         insndescs = [{insndesc['instruction']: insndesc['value']} for insndesc in self.structure]
         return json.dumps(insndescs)
 
@@ -338,28 +427,35 @@ class DockerfileParser(object):
         """
         :return: list of parent images -- one image per each stage's FROM instruction
         """
-        in_stage = False
-        top_args = {}
+        structure = self.structure
+        top_args = self._top_args(structure)
         parents = []
-        for instr in self.structure:
-            if instr['instruction'] == 'ARG':
-                if not in_stage:
-                    key_val_list = extract_key_values(
-                        env_replace=False,
-                        args={}, envs={},
-                        instruction_value=instr['value'])
-                    for key, value in key_val_list:
-                        if key in self.build_args:
-                            value = self.build_args[key]
-                        top_args[key] = value
-            elif instr['instruction'] == 'FROM':
-                in_stage = True
+        for instr in structure:
+            if instr['instruction'] == 'FROM':
                 image, _ = image_from(instr['value'])
                 if image is not None:
                     image = WordSplitter(image, args=top_args).dequote()
                     parents.append(image)
         return parents
 
+    def _top_args(self, structure):
+        """
+        :param structure: list of dicts describing the commands
+        :return: dict of ARGs declared before the first FROM instruction
+        """
+        top_args = {}
+        for instr in structure:
+            if instr['instruction'] == 'FROM':
+                break
+            if instr['instruction'] == 'ARG':
+                key_val_list = extract_key_values(
+                    env_replace=False,
+                    args={}, envs={},
+                    instruction_value=instr['value'])
+                for key, value in key_val_list:
+                    top_args[key] = self.build_args.get(key, value)
+        return top_args
+
     @parent_images.setter
     def parent_images(self, parents):
         """
@@ -372,7 +468,8 @@ class DockerfileParser(object):
         """
         parents = list(parents)
         change_instrs = []
-        for instr in self.structure:
+        lines, structure = self._lines_and_structure()
+        for instr in structure:
             if instr['instruction'] != 'FROM':
                 continue
 
@@ -391,7 +488,6 @@ class DockerfileParser(object):
         if parents:
             raise RuntimeError("trying to update too many parents for build stages")
 
-        lines = self.lines
         for instr in reversed(change_instrs):
             lines[instr['startline']:instr['endline']+1] = [instr['content']]
 
@@ -406,7 +502,13 @@ class DockerfileParser(object):
         """
         :return: base image, i.e. value of final stage FROM instruction
         """
-        return (self.parent_images or [None])[-1]
+        structure = self.structure
+        for instr in reversed(structure):
+            if instr['instruction'] == 'FROM':
+                image, _ = image_from(instr['value'])
+                if image is not None:
+                    return WordSplitter(image, args=self._top_args(structure)).dequote()
+        return None
 
     @baseimage.setter
     def baseimage(self, new_image):
@@ -482,23 +584,27 @@ class DockerfileParser(object):
         """
         return self._instruction_getter('ARG', env_replace=self.env_replace)
 
-    def _instruction_getter(self, name, env_replace):
+    def _instruction_getter(self, name, env_replace, structure=None):
         """
         Get LABEL or ENV or ARG instructions with environment replacement
 
         :param name: e.g. 'LABEL' or 'ENV' or 'ARG'
         :param env_replace: bool, whether to perform ENV substitution
+        :param structure: list of dicts describing the commands,
+            by default the structure of the current content
         :return: Labels instance or Envs instance
         """
         if name not in ('LABEL', 'ENV', 'ARG'):
             raise ValueError("Unsupported instruction '{0}'".format(name))
+        if structure is None:
+            structure = self.structure
         in_stage = False
         top_args = {}
         instructions = {}
         args = {}
         envs = {}
 
-        for instruction_desc in self.structure:
+        for instruction_desc in structure:
             this_instruction = instruction_desc['instruction']
             if this_instruction == 'FROM':
                 in_stage = True
@@ -516,12 +622,11 @@ class DockerfileParser(object):
                         if in_stage:
                             if key in top_args:
                                 value = top_args[key]
-                            elif key in self.build_args:
-                                value = self.build_args[key]
+                            else:
+                                value = self.build_args.get(key, value)
                             args[key] = value
                         else:
-                            if key in self.build_args:
-                                value = self.build_args[key]
+                            value = self.build_args.get(key, value)
                             top_args[key] = value
                     if this_instruction == name:
                         instructions[key] = value
@@ -565,32 +670,37 @@ class DockerfileParser(object):
         if not isinstance(instructions, dict):
             raise TypeError('instructions needs to be a dictionary {name: value}')
 
-        if name == 'LABEL':
-            existing = self.labels
-        elif name == 'ENV':
-            existing = self.envs
-        elif name == 'ARG':
-            existing = self.args
-        else:
+        if name not in ('LABEL', 'ENV', 'ARG'):
             raise ValueError("Unexpected instruction '%s'" % name)
 
+        # all the edits are made to the lines in memory, which are written once
+        lines, structure = self._lines_and_structure()
+        existing = self._instruction_getter(name, env_replace=self.env_replace,
+                                            structure=structure)
+
         logger.debug("setting %s instructions: %r", name, instructions)
 
         to_delete = [k for k in existing if k not in instructions]
         for key in to_delete:
             logger.debug("delete %r", key)
-            self._modify_instruction_label_env(name, key, None)
+            self._modify_label_env_lines(lines, structure, name, key, None)
+            structure = None  # parse the edited lines again when needed
 
         to_add = dict((k, v) for (k, v) in instructions.items() if k not in existing)
         for k, v in to_add.items():
             logger.debug("add %r", k)
-            self._add_instruction(name, (k, v))
+            _append_instruction(lines, name, (k, v))
+            structure = None
 
         to_change = dict((k, v) for (k, v) in instructions.items()
                          if (k in existing and v != existing[k]))
         for k, v in to_change.items():
             logger.debug("modify %r", k)
-            self._modify_instruction_label_env(name, k, v)
+            self._modify_label_env_lines(lines, structure, name, k, v)
+            structure = None
+
+        if structure is None:  # something was changed
+            self.lines = lines
 
     def _modify_instruction_label(self, label_key, instr_value):
         self._modify_instruction_label_env('LABEL', label_key, instr_value)
@@ -608,21 +718,34 @@ class DockerfileParser(object):
         :param instr_key: str, label key
         :param instr_value: str or None, new label/env value or None to remove
         """
-        if instruction == 'LABEL':
-            instructions = self.labels
-        elif instruction == 'ENV':
-            instructions = self.envs
-        elif instruction == 'ARG':
-            instructions = self.args
-        else:
+        if instruction not in ('LABEL', 'ENV', 'ARG'):
             raise ValueError("Unknown instruction '%s'" % instruction)
 
-        if instr_key not in instructions:
+        lines, structure = self._lines_and_structure()
+        self._modify_label_env_lines(lines, structure, instruction, instr_key, instr_value)
+        self.lines = lines
+
+    def _modify_label_env_lines(self, lines, structure, instruction, instr_key, instr_value):
+        """
+        set <INSTRUCTION> instr_key to instr_value in lines, without writing them
+
+        :param lines: list of lines (unicode), modified in place
+        :param structure: list of dicts describing the commands in lines,
+            or None to parse them again
+        :param instr_key: str, label key
+        :param instr_value: str or None, new label/env value or None to remove
+        """
+        if structure is None:
+            structure = self._parse_structure(lines)
+
+        existing = self._instruction_getter(instruction, env_replace=self.env_replace,
+                                            structure=structure)
+        if instr_key not in existing:
             raise KeyError('%s not in %ss' % (instr_key, instruction))
 
         # extract target instructions from the final stage only
         candidates = []
-        for insn in self.structure:
+        for insn in structure:
             if insn['instruction'] == 'FROM':
                 candidates = []
             if insn['instruction'] == instruction:
@@ -677,12 +800,7 @@ class DockerfileParser(object):
         # We know the label/env we're looking for is there
         assert startline and endline
 
-        # Re-write the Dockerfile
-        lines = self.lines
-        del lines[startline:endline + 1]
-        if content:
-            lines.insert(startline, content)
-        self.lines = lines
+        lines[startline:endline + 1] = [content] if content else []
 
     def _delete_instructions(self, instruction, value=None):
         """
@@ -700,9 +818,9 @@ class DockerfileParser(object):
             self._modify_instruction_arg(value, None)
             return
 
-        lines = self.lines
+        lines, structure = self._lines_and_structure()
         deleted = False
-        for insn in reversed(self.structure):
+        for insn in reversed(structure):
             if insn['instruction'] == instruction:
                 if value and insn['value'] != value:
                     continue
@@ -716,16 +834,9 @@ class DockerfileParser(object):
         :param instruction: instruction name to be added
         :param value: instruction value
         """
-        if instruction in ('LABEL', 'ENV', 'ARG') and len(value) == 2:
-            new_line = instruction + ' ' + '='.join(map(quote, value)) + '\n'
-        else:
-            new_line = '{0} {1}\n'.format(instruction, value)
-        if new_line:
-            lines = self.lines
-            if not lines[len(lines) - 1].endswith('\n'):
-                new_line = '\n' + new_line
-            lines += new_line
-            self.lines = lines
+        lines = self.lines
+        _append_instruction(lines, instruction, value)
+        self.lines = lines
 
     def add_lines(self, *lines, **kwargs):
         """
@@ -743,31 +854,37 @@ class DockerfileParser(object):
         skip_scratch = kwargs.pop('skip_scratch', False)
         assert not kwargs, "Unknown keyword argument(s): {0}".format(list(kwargs))
 
+        df_lines, structure = self._lines_and_structure()
         froms = [
-            instr for instr in self.structure
+            instr for instr in structure
             if instr['instruction'] == 'FROM'
         ] or [{'endline': -1}]  # no FROM? fake one before the beginning
         if not all_stages:  # only modify the last
             froms = [froms[-1]]
 
-        df_lines = self.lines
         # make sure last line has a newline if lines are to be appended
         if df_lines and not at_start:
             df_lines[-1] = _endline(df_lines[-1])
 
-        # iterate through the stages in reverse order
-        # so adding lines doesn't invalidate line numbers from structure dicts.
+        # find where the lines go in each stage, in order of the line numbers;
         # first add a bogus instruction to represent EOF in our iteration.
         froms.append({'startline': len(df_lines) + 1})
-        for stage in range(len(froms)-2, -1, -1):  # e.g. 0 for single or 2, 1, 0 for 3 stages
-            start, finish = froms[stage], froms[stage+1]
-            linenum = start['endline'] + 1 if at_start else finish['startline']
-            image, _ = image_from(froms[stage].get('value') or '')
-            if skip_scratch and image == 'scratch':
+        linenums = []
+        for start, finish in zip(froms, froms[1:]):
+            if skip_scratch and image_from(start.get('value') or '')[0] == 'scratch':
                 continue
-            df_lines[linenum:linenum] = lines
+            linenums.append(start['endline'] + 1 if at_start else finish['startline'])
 
-        self.lines = df_lines
+        # build the new content in a single pass instead of inserting per stage
+        new_lines = []
+        last = 0
+        for linenum in linenums:
+            new_lines.extend(df_lines[last:linenum])
+            new_lines.extend(lines)
+            last = linenum
+        new_lines.extend(df_lines[last:])
+
+        self.lines = new_lines
 
     def add_lines_at(self, anchor, *lines, **kwargs):
         """
@@ -784,13 +901,16 @@ class DockerfileParser(object):
         assert not kwargs, "Unknown keyword argument(s): {0}".format(list(kwargs))
 
         # find the line number for the insertion
-        df_lines = self.lines
+        if isinstance(anchor, dict):
+            df_lines, structure = self._lines_and_structure()
+        else:
+            df_lines = self.lines
         if isinstance(anchor, int):  # line number, just validate
             assert 0 <= anchor < len(df_lines)
             if replace:
                 del df_lines[anchor]
         elif isinstance(anchor, dict):  # structure
-            assert anchor in self.structure, "Current structure does not match: {0}".format(anchor)
+            assert anchor in structure, "Current structure does not match: {0}".format(anchor)
             if replace:
                 df_lines[anchor['startline']:anchor['endline'] + 1] = []
             if after:
@@ -798,10 +918,13 @@ class DockerfileParser(object):
             else:
                 anchor = anchor['startline']
         elif isinstance(anchor, str):  # line contents
-            matches = [index for index, text in enumerate(df_lines) if text == anchor]
-            if not matches:
+            # the last matching line is wanted, so search from the end
+            for index in range(len(df_lines) - 1, -1, -1):
+                if df_lines[index] == anchor:
+                    anchor = index
+                    break
+            else:
                 raise RuntimeError("Cannot find line in the build file:\n" + anchor)
-            anchor = matches[-1]
             if replace:
                 del df_lines[anchor]
         else:
@@ -829,11 +952,11 @@ class DockerfileParser(object):
             instruction_type = instr['instruction']
             if instruction_type == "FROM":  # reset per stage
                 in_stage = True
-                last_context = Context(envs=dict(self.parent_env))
-
-            context = Context(args=dict(last_context.args),
-                              envs=dict(last_context.envs),
-                              labels=dict(last_context.labels))
+                context = Context(envs=dict(self.parent_env))
+            else:
+                context = Context(args=dict(last_context.args),
+                                  envs=dict(last_context.envs),
+                                  labels=dict(last_context.labels))
 
             if instruction_type in ('ARG', 'ENV', 'LABEL'):
                 values = get_key_val_dictionary(
@@ -843,15 +966,14 @@ class DockerfileParser(object):
                     envs=last_context.envs)
                 if instruction_type == 'ARG' and self.env_replace:
                     if in_stage:
-                        for key in list(values.keys()):
+                        for key, value in list(values.items()):
                             if key in top_args:
                                 values[key] = top_args[key]
-                            elif key in self.build_args:
-                                values[key] = self.build_args[key]
+                            else:
+                                values[key] = self.build_args.get(key, value)
                     else:
                         for key, value in list(values.items()):
-                            if key in self.build_args:
-                                value = self.build_args[key]
+                            value = self.build_args.get(key, value)
                             top_args[key] = value
                             values[key] = value
                 context.set_line_value(context_type=instruction_type, value=values)
@@ -861,25 +983,40 @@ class DockerfileParser(object):
         return instructions
 
 
+@lru_cache(maxsize=256)
 def image_from(from_value):
     """
     :param from_value: string like "image:tag" or "image:tag AS name"
     :return: tuple of the image and stage name, e.g. ("image:tag", None)
     """
-    regex = re.compile(r"""(?xi)        # readable, case-insensitive regex
-        \s*                             # ignore leading whitespace
-        (?P<platform> --platform=\S+)?  # optional platform parameter
-        \s*                             # more whitespaces
-        (?P<image> \S+ )                # image and optional tag
-        (?:                             # optional "AS name" clause for stage
-            \s+ AS \s+
-            (?P<name> \S+ )
-        )?
-        """)
-    match = re.match(regex, from_value)
+    match = _IMAGE_FROM_RE.match(from_value)
     return match.group('image', 'name') if match else (None, None)
 
 
+def _split_lines(content):
+    """
+    Split content into lines, keeping line endings.
+    Unlike str.splitlines(), only '\\n' is treated as a line boundary.
+    """
+    return _LINE_RE.findall(content)
+
+
+def _append_instruction(lines, instruction, value):
+    """
+    Append an instruction to the lines, each line stays a single line.
+    :param lines: list of lines (unicode), modified in place
+    :param instruction: instruction name to be added
+    :param value: instruction value, (key, value) for LABEL/ENV/ARG
+    """
+    if instruction in ('LABEL', 'ENV', 'ARG') and len(value) == 2:
+        new_line = instruction + ' ' + '='.join(map(quote, value)) + '\n'
+    else:
+        new_line = '{0} {1}\n'.format(instruction, value)
+    if not lines[len(lines) - 1].endswith('\n'):
+        lines[-1] += '\n'
+    lines.append(new_line)
+
+
 def _endline(line):
     """
     Make sure the line ends with a single newline.
@@ -7,7 +7,16 @@ This software may be modified and distributed under the terms
 of the BSD license. See the LICENSE file for details.
 """
 
-from io import StringIO
+import re
+import sys
+
+
+# variable reference following '$': optional opening brace(s) and the name
+_VARIABLE_RE = re.compile(r'(\{*)(\w*)')
+# run of characters which never change the quoting or splitting state
+_PLAIN_RUN_RE = re.compile(r'[^\s\\\'"$]+')
+# characters which make WordSplitter do more than split at whitespace
+_QUOTING_RE = re.compile(r'[\'"\\]')
 
 
 def b2u(string):
@@ -24,6 +33,26 @@ def u2b(string):
     return string
 
 
+class _Word(object):
+    """
+    A None-or-str object which can always be appended to.
+    Similar to a defaultdict but with only a single value.
+    """
+
+    def __init__(self):
+        self.value = None
+
+    @property
+    def valid(self):
+        return self.value is not None
+
+    def append(self, s):
+        if self.value is None:
+            self.value = s
+        else:
+            self.value += s
+
+
 class WordSplitter(object):
     """
     Split string into words, substituting environment variables if provided
@@ -48,7 +77,8 @@ class WordSplitter(object):
         :param envs: dict, environment variables to use; if None, do not
             attempt substitution
         """
-        self.stream = StringIO(s)
+        self.string = s
+        self.pos = 0  # index of the next character to process
         self.args = args
         self.envs = envs
 
@@ -98,6 +128,11 @@ class WordSplitter(object):
         return ch
 
     def dequote(self):
+        if (not self.pos and
+                not _QUOTING_RE.search(self.string) and
+                ('$' not in self.string or (self.envs is None and self.args is None))):
+            # nothing to dequote or substitute, e.g. a plain key name
+            return self.string
         return ''.join(self.split(maxsplit=0))
 
     def split(self, maxsplit=None, dequote=True):
@@ -109,66 +144,54 @@ class WordSplitter(object):
         :param dequote: remove quotes and escape characters once consumed
         """
 
-        class Word(object):
-            """
-            A None-or-str object which can always be appended to.
-            Similar to a defaultdict but with only a single value.
-            """
-
-            def __init__(self):
-                self.value = None
-
-            @property
-            def valid(self):
-                return self.value is not None
-
-            def append(self, s):
-                if self.value is None:
-                    self.value = s
-                else:
-                    self.value += s
+        # local names for what is looked up on every character
+        string = self.string
+        envs = self.envs
+        args = self.args
+        substitute = envs is not None or args is not None
+        plain_run_match = _PLAIN_RUN_RE.match
+        variable_match = _VARIABLE_RE.match
+        update_quoting_state = self._update_quoting_state
+        pos = self.pos
 
         num_splits = 0
-        word = Word()
+        word = _Word()
         while True:
-            ch = self.stream.read(1)
+            if not self.escaped:
+                # consume a whole run of ordinary characters at once
+                match = plain_run_match(string, pos)
+                if match:
+                    word.append(match.group())
+                    pos = match.end()
+
+            ch = string[pos:pos + 1]
+            pos += 1
             if not ch:
                 # EOF
+                self.pos = pos
                 if word.valid:
                     yield word.value
 
                 return
 
-            if (not self.escaped and
-                    (self.envs is not None or self.args is not None) and
+            if (substitute and
+                    not self.escaped and
                     ch == '$' and
                     self.quotes != self.SQUOTE):
                 while True:
-                    # Substitute environment variable
-                    braced = False
-                    varname = ''
-                    while True:
-                        ch = self.stream.read(1)
-                        if varname == '' and ch == '{':
-                            braced = True
-                            continue
-
-                        if not ch:
-                            # EOF
-                            break
-
-                        if braced and ch == '}':
-                            break
-
-                        if not ch.isalnum() and ch != '_':
-                            break
-
-                        varname += ch
-
-                    if self.envs is not None and varname in self.envs:
-                        word.append(self.envs[varname])
-                    elif self.args is not None and varname in self.args:
-                        word.append(self.args[varname])
+                    # Substitute environment variable; the name ends at
+                    # the first character which is not alphanumeric or '_'
+                    match = variable_match(string, pos)
+                    braced = bool(match.group(1))
+                    varname = match.group(2)
+                    # consume the name and the character following it
+                    ch = string[match.end():match.end() + 1]
+                    pos = match.end() + 1
+
+                    if envs is not None and varname in envs:
+                        word.append(envs[varname])
+                    elif args is not None and varname in args:
+                        word.append(args[varname])
 
                     # Check whether there is another envvar
                     if ch != '$':
@@ -182,7 +205,7 @@ class WordSplitter(object):
             # Figure out what our quoting/escaping state will be
             # after this character
             is_escaped = self.escaped
-            ch_unless_consumed = self._update_quoting_state(ch)
+            ch_unless_consumed = update_quoting_state(ch)
 
             if dequote:
                 # If we just processed a quote or escape character,
@@ -200,15 +223,20 @@ class WordSplitter(object):
                 # It is time to yield a word
                 if word.valid:
                     num_splits += 1
+                    self.pos = pos
                     yield word.value
 
-                word = Word()
+                word = _Word()
             else:
                 word.append(ch)
 
 
 def extract_key_values(env_replace, args, envs, instruction_value):
-    words = list(WordSplitter(instruction_value).split(dequote=False))
+    if _QUOTING_RE.search(instruction_value):
+        words = list(WordSplitter(instruction_value).split(dequote=False))
+    else:
+        # nothing quoted or escaped, splitting at whitespace is enough
+        words = instruction_value.split()
     key_val_list = []
 
     def substitute_vars(val):
@@ -224,7 +252,8 @@ def extract_key_values(env_replace, args, envs, instruction_value):
         #   LABEL/ENV name value
         # The first word is the name, remainder are the value.
         key_val = [substitute_vars(x) for x in instruction_value.split(None, 1)]
-        key = key_val[0]
+        # keys are interned, the same names come up on many lines and parses
+        key = sys.intern(key_val[0])
         try:
             val = key_val[1]
         except IndexError:
@@ -241,7 +270,7 @@ def extract_key_values(env_replace, args, envs, instruction_value):
                                  'Must be of the form: name=value'
                                  .format(word=k_v))
             key, val = [substitute_vars(x) for x in k_v.split('=', 1)]
-            key_val_list.append((key, val))
+            key_val_list.append((sys.intern(key), val))
 
     return key_val_list
 
@@ -254,7 +283,18 @@ def get_key_val_dictionary(instruction_value, env_replace=False, args=None, envs
                                    args=args, envs=envs))
 
 
+# context type -> (attribute with all values, attribute with values on this line)
+_CONTEXT_ATTRIBUTES = {
+    'ARG': ('args', 'line_args'),
+    'ENV': ('envs', 'line_envs'),
+    'LABEL': ('labels', 'line_labels'),
+}
+
+
 class Context(object):
+    # one instance is created per instruction, keep them small
+    __slots__ = ('args', 'envs', 'labels', 'line_args', 'line_envs', 'line_labels')
+
     def __init__(self, args=None, envs=None, labels=None,
                  line_args=None, line_envs=None, line_labels=None):
         """
@@ -277,6 +317,19 @@ class Context(object):
         self.line_envs = line_envs or {}
         self.line_labels = line_labels or {}
 
+    @staticmethod
+    def _attributes(context_type):
+        """
+        Get names of the attributes holding values of the given type.
+
+        :param context_type: "ARG" or "ENV" or "LABEL"
+        :return: tuple of attribute names (all values, values on this line)
+        """
+        attributes = _CONTEXT_ATTRIBUTES.get(context_type.upper())
+        if attributes is None:
+            raise ValueError("Unexpected context type: " + context_type)
+        return attributes
+
     def set_line_value(self, context_type, value):
         """
         Set value defined on this line ('line_args'/'line_envs'/'line_labels')
@@ -285,17 +338,9 @@ class Context(object):
         :param context_type: "ARG" or "ENV" or "LABEL"
         :param value: new value for this line
         """
-        if context_type.upper() == "ARG":
-            self.line_args = value
-            self.args.update(value)
-        elif context_type.upper() == "ENV":
-            self.line_envs = value
-            self.envs.update(value)
-        elif context_type.upper() == "LABEL":
-            self.line_labels = value
-            self.labels.update(value)
-        else:
-            raise ValueError("Unexpected context type: " + context_type)
+        values_attr, line_values_attr = self._attributes(context_type)
+        setattr(self, line_values_attr, value)
+        getattr(self, values_attr).update(value)
 
     def get_line_value(self, context_type):
         """
@@ -304,13 +349,7 @@ class Context(object):
         :param context_type: "ARG" or "ENV" or "LABEL"
         :return: values of given type defined on this line
         """
-        if context_type.upper() == "ARG":
-            return self.line_args
-        if context_type.upper() == "ENV":
-            return self.line_envs
-        if context_type.upper() == "LABEL":
-            return self.line_labels
-        raise ValueError("Unexpected context type: " + context_type)
+        return getattr(self, self._attributes(context_type)[1])
 
     def get_values(self, context_type):
         """
@@ -319,10 +358,4 @@ class Context(object):
         :param context_type: "ARG" or "ENV" or "LABEL"
         :return: values of given type valid on this line
         """
-        if context_type.upper() == "ARG":
-            return self.args
-        if context_type.upper() == "ENV":
-            return self.envs
-        if context_type.upper() == "LABEL":
-            return self.labels
-        raise ValueError("Unexpected context type: " + context_type)
+        return getattr(self, self._attributes(context_type)[0])
@@ -23,6 +23,10 @@ from dockerfile_parse.util import b2u, u2b, Context
 from tests.fixtures import dfparser, instruction
 
 NON_ASCII = "žluťoučký"
+BASIC_DF_CONTENT = dedent("""\
+    FROM fedora
+    LABEL label={0}""".format(NON_ASCII))
+BASIC_DF_LINES = ["FROM fedora\n", "LABEL label={0}".format(NON_ASCII)]
 # flake8 does not understand fixtures:
 dfparser = dfparser  # pylint: disable=self-assigning-variable
 instruction = instruction  # pylint: disable=self-assigning-variable
@@ -33,11 +37,11 @@ class TestDockerfileParser(object):
         def read_version(fp, regex):
             with open(fp, "r") as fd:
                 content = fd.read()
-                found = re.findall(regex, content)
-                if len(found) == 1:
-                    return found[0]
-                else:
-                    raise Exception("Version not found!")
+            # exactly one match is expected
+            match = regex.search(content)
+            if match and not regex.search(content, match.end()):
+                return match.group(1)
+            raise Exception("Version not found!")
 
         import dockerfile_parse
         from dockerfile_parse import __version__ as module_version
@@ -45,8 +49,8 @@ class TestDockerfileParser(object):
         project_dir = os.path.dirname(os.path.dirname(fp))
         specfile = os.path.join(project_dir, "python-dockerfile-parse.spec")
         setup_py = os.path.join(project_dir, "setup.py")
-        spec_version = read_version(specfile, r"\nVersion:\s*(.+?)\s*\n")
-        setup_py_version = read_version(setup_py, r"version=['\"](.+)['\"]")
+        spec_version = read_version(specfile, re.compile(r"\nVersion:\s*(.+?)\s*\n"))
+        setup_py_version = read_version(setup_py, re.compile(r"version=['\"](.+)['\"]"))
         assert spec_version == module_version
         assert setup_py_version == module_version
 
@@ -68,10 +72,8 @@ class TestDockerfileParser(object):
             context.set_line_value('FOO', {})
 
     def test_dockerfileparser(self, dfparser, tmpdir):
-        df_content = dedent("""\
-            FROM fedora
-            LABEL label={0}""".format(NON_ASCII))
-        df_lines = ["FROM fedora\n", "LABEL label={0}".format(NON_ASCII)]
+        df_content = BASIC_DF_CONTENT
+        df_lines = BASIC_DF_LINES
 
         dfparser.content = ""
         dfparser.content = df_content
@@ -85,6 +87,17 @@ class TestDockerfileParser(object):
         assert dfparser.lines == df_lines
         assert [isinstance(line, str) for line in dfparser.lines]
 
+        dfparser.content = ""
+        dfparser.lines = [line.encode('utf-8') for line in df_lines[:1]] + df_lines[1:]
+        assert dfparser.content == df_content
+        assert dfparser.lines == df_lines
+
+        dfparser.content = ""
+        dfparser.lines = (line.encode('utf-8') if not i else line
+                          for i, line in enumerate(df_lines))
+        assert dfparser.content == df_content
+        assert dfparser.lines == df_lines
+
         dockerfile = os.path.join(str(tmpdir), 'Dockerfile')
         with open(dockerfile, 'wb') as fp:
             fp.write(df_content.encode('utf-8'))
@@ -93,11 +106,15 @@ class TestDockerfileParser(object):
         assert dfparser.lines == df_lines
         assert [isinstance(line, str) for line in dfparser.lines]
 
+    def test_lines_split_on_newline_only(self, dfparser):
+        df_content = "FROM fedora\nLABEL a=b\rc\x0cd\nRUN true"
+        dfparser.content = df_content
+        assert dfparser.lines == ["FROM fedora\n", "LABEL a=b\rc\x0cd\n", "RUN true"]
+        assert ''.join(dfparser.lines) == df_content
+
     def test_dockerfileparser_exceptions(self, tmpdir):
-        df_content = dedent("""\
-            FROM fedora
-            LABEL label={0}""".format(NON_ASCII))
-        df_lines = ["FROM fedora\n", "LABEL label={0}".format(NON_ASCII)]
+        df_content = BASIC_DF_CONTENT
+        df_lines = BASIC_DF_LINES
 
         dfp = DockerfileParser(os.path.join(str(tmpdir), 'no-directory'))
         with pytest.raises(IOError):
@@ -225,6 +242,82 @@ class TestDockerfileParser(object):
                                        'content': 'RUN command4 && \\\n    command5\n',
                                        'value': 'command4 &&     command5'}]
 
+    def test_dockerfile_structure_cache(self, dfparser, tmpdir):
+        dfparser.content = "FROM fedora\nCMD yum -y update\n"
+        structure = dfparser.structure
+        structure[0]['value'] = 'centos'
+        assert dfparser.structure[0]['value'] == 'fedora'
+        lines = dfparser.lines
+        lines.append('RUN true\n')
+        assert dfparser.lines == ["FROM fedora\n", "CMD yum -y update\n"]
+
+        dfparser.content = "FROM centos\n"
+        assert [insn['value'] for insn in dfparser.structure] == ['centos']
+
+        # changes made outside of the parser are noticed
+        tmpdir_path = str(tmpdir.realpath())
+        dfp = DockerfileParser(tmpdir_path)
+        dfp.content = "FROM fedora\n"
+        assert dfp.structure[0]['value'] == 'fedora'
+        with open(dfp.dockerfile_path, 'w') as fp:
+            fp.write("FROM centos\n")
+        assert dfp.structure[0]['value'] == 'centos'
+
+    def test_dockerfile_structure_parsed_once(self, dfparser, monkeypatch):
+        dfparser.content = dedent("""\
+            ARG img=fedora
+            FROM $img AS builder
+            LABEL a=b
+            FROM base
+            ENV c=d
+            CMD run
+            """)
+        calls = []
+        parse_structure = dfparser._parse_structure
+        monkeypatch.setattr(dfparser, '_parse_structure',
+                            lambda lines: calls.append(lines) or parse_structure(lines))
+
+        for attr in ('structure', 'json', 'labels', 'envs', 'args', 'parent_images',
+                     'is_multistage', 'baseimage', 'cmd', 'context_structure'):
+            getattr(dfparser, attr)
+        assert len(calls) == 1
+
+        dfparser.labels = {'x': 'y'}
+        assert dfparser.labels == {'x': 'y'}
+        calls_after_edit = len(calls)
+        assert dfparser.envs == {'c': 'd'}
+        assert len(calls) == calls_after_edit
+
+    def test_setter_writes_once(self, dfparser, monkeypatch):
+        dfparser.content = dedent("""\
+            FROM fedora
+            LABEL a=b c=d
+            LABEL e f
+            """)
+        modes = []
+        open_dockerfile = dfparser._open_dockerfile
+        monkeypatch.setattr(dfparser, '_open_dockerfile',
+                            lambda mode: modes.append(mode) or open_dockerfile(mode))
+
+        dfparser.labels = {'a': 'x', 'e': 'f', 'g': 'h'}
+        assert modes.count('wb') == 1
+        assert dfparser.content == dedent("""\
+            FROM fedora
+            LABEL a=x
+            LABEL e f
+            LABEL g=h
+            """)
+
+    def test_setter_failure_leaves_content(self, dfparser):
+        # the bare FROM only becomes an instruction once a line is added after
+        # it, so the top-level ARG is no longer in the final stage when changed;
+        # the KeyError is raised before anything is written
+        dfparser.content = 'ARG A="x y"\nFROM'
+        assert dfparser.args == {'A': 'x y'}
+        with pytest.raises(KeyError):
+            dfparser.args = {'A': 'z', 'new': 'v'}
+        assert dfparser.content == 'ARG A="x y"\nFROM'
+
     def test_invalid_dockerfile_structure(self, dfparser):
         '''Invalid instruction is reserverd.'''
         dfparser.content = dedent("""\
@@ -677,7 +770,7 @@ class TestDockerfileParser(object):
                 dfparser._delete_instructions(instruction, delete_key)
         else:
             dfparser._delete_instructions(instruction, delete_key)
-            assert set(dfparser.lines[1:]) == set(expected)
+            assert dfparser.lines[1:] == expected
 
     @pytest.mark.parametrize(('existing',
                               'new',
@@ -743,7 +836,7 @@ class TestDockerfileParser(object):
         elif instruction == 'ARG':
             dfparser.args = new
             assert dfparser.args == new
-        assert set(dfparser.lines[1:]) == set(expected)
+        assert dfparser.lines[1:] == expected
 
     @pytest.mark.parametrize(('old_instructions', 'key', 'new_value', 'expected'), [
         # Simple case, no '=' or quotes
@@ -915,6 +1008,22 @@ class TestDockerfileParser(object):
         with pytest.raises((AttributeError, io.UnsupportedOperation)):
             DockerfileParser(fileobj=sys.stdin)
 
+    @pytest.mark.parametrize('content', [BASIC_DF_CONTENT, BASIC_DF_CONTENT.encode('utf-8')])
+    def test_from_string(self, tmpdir, content):
+        with tmpdir.as_cwd():
+            dfp = DockerfileParser.from_string(content, build_args={'a': 'b'})
+            assert dfp.content == BASIC_DF_CONTENT
+            assert dfp.lines == BASIC_DF_LINES
+            assert dfp.labels == {'label': NON_ASCII}
+            assert dfp.build_args == {'a': 'b'}
+
+            dfp.baseimage = 'centos'
+            assert dfp.lines[0] == 'FROM centos\n'
+            assert tmpdir.listdir() == []
+
+        with pytest.raises(ValueError):
+            DockerfileParser.from_string(content, path='.')
+
     def test_context_structure_per_line(self, dfparser, instruction):
         dfparser.content = dedent("""\
             FROM fedora:25